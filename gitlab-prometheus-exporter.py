@@ -4,25 +4,33 @@
 Scrapes gitlab on an interval and exposes metrics about pipelines.
 """
 
+import collections
 import logging
 import os
+import sys
 import datetime
 import time
 import urllib
 
-import arrow
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
 import requests
 
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
-from prometheus_client.core import (
+from prometheus_client import (
+    GC_COLLECTOR,
+    PLATFORM_COLLECTOR,
+    PROCESS_COLLECTOR,
     REGISTRY,
-    CounterMetricFamily,
-    GaugeMetricFamily,
-    HistogramMetricFamily,
+    Counter,
+    Gauge,
+    Histogram,
+    disable_created_metrics,
+    start_http_server,
 )
-from prometheus_client import start_http_server
 
 
 # Required inputs
@@ -30,26 +38,93 @@ GITLAB_URL = os.environ['GITLAB_URL']
 PROJECTS = [p.strip() for p in os.environ['GITLAB_PROJECTS'].split(',')]
 TOKEN = os.environ['GITLAB_TOKEN']
 
+PROJECT_URLS = {
+    project: f"{GITLAB_URL}/api/v4/projects/{urllib.parse.quote_plus(project)}/pipelines"
+    for project in PROJECTS
+}
+PIPELINE_PARAMS = dict(order_by='updated_at', sort='asc', per_page=100)
+
+# Upper bound on the threads fetching branches, and separately on the threads fetching pages
+MAX_WORKERS = int(os.environ.get('GITLAB_MAX_WORKERS', '16'))
+
 retry_strategy = Retry(
     total=3,
     backoff_factor=1,
     status_forcelist=[429, 500, 502, 503, 504],
     allowed_methods=["HEAD", "GET", "OPTIONS"]
 )
-adapter = HTTPAdapter(max_retries=retry_strategy)
+# Keep a pooled connection for every thread that can be talking to gitlab at once
+adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=2 * MAX_WORKERS)
 session = requests.Session()
 session.mount("https://", adapter)
 session.mount("http://", adapter)
-session.headers = {'Authorization': f'Bearer {TOKEN}'}
+# Add to, rather than replace, the default headers which ask for gzip and keep-alive
+session.headers.update({'Authorization': f'Bearer {TOKEN}'})
 
 LABELS = ['project', 'branch']
 BRANCHES = ['master', 'main']
+PROJECT_BRANCHES = [(project, branch) for project in PROJECTS for branch in BRANCHES]
+# The day the exporter started.  Branches that have no watermark yet are fetched from here.
 START = None
-metrics = {}
+
+# Branches are fetched on one pool and hand their extra pages to a separate one, so a branch
+# waiting on its pages can never starve the pool that is serving them.  Both pools live as long
+# as the exporter, so their threads are reused by every scrape.
+branch_executor = ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(PROJECT_BRANCHES)))
+page_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+# Pipelines we have seen, keyed by (project, branch) and then by pipeline id.  Each scrape merges
+# in only the pipelines that changed since the latest updated_at seen for that branch.
+_pipeline_store = {}
+_last_updated_at = {}
+# How far before the watermark each scrape reaches back, so rows whose updated_at was committed
+# after we fetched past it are picked up again.  Re-reading a stored pipeline is harmless.
+WATERMARK_OVERLAP = datetime.timedelta(minutes=5)
+# How long finished pipelines are remembered after their last update.  It has to outlast any
+# pipeline's lifetime, so that one retried days later is still recognised as already counted.
+RETENTION = datetime.timedelta(days=7)
+_pruned_on = None
+
+# Durations of the pipelines we have seen succeed, keyed by id.  A pipeline's duration is
+# observed once, when we first see it succeed, even if it is retried and succeeds again later.
+_durations = {}
 
 # In seconds
 DURATION_BUCKETS = [180, 300, 600, 900, 1200, 1500, 1800, 2100, 2400, 2700]
 
+# The metrics are updated in place from the pipelines that change between scrapes.  Don't add
+# a *_created series alongside each counter and histogram.
+disable_created_metrics()
+gitlab_pipelines_total = Counter(
+    'gitlab_pipelines_total', 'Count of all gitlab pipelines', LABELS
+)
+gitlab_pipeline_errors_total = Counter(
+    'gitlab_pipeline_errors_total', 'Count of all gitlab pipeline errors', LABELS
+)
+gitlab_in_progress_pipelines = Gauge(
+    'gitlab_in_progress_pipelines', 'Count of all in-progress gitlab pipelines', LABELS
+)
+gitlab_pipeline_duration_seconds = Histogram(
+    'gitlab_pipeline_duration_seconds',
+    'Histogram of gitlab pipeline durations',
+    LABELS,
+    buckets=DURATION_BUCKETS,
+)
+# Expose every project and branch from the start, even before it has any pipelines
+for metric in (
+    gitlab_pipelines_total,
+    gitlab_pipeline_errors_total,
+    gitlab_in_progress_pipelines,
+    gitlab_pipeline_duration_seconds,
+):
+    for key in PROJECT_BRANCHES:
+        metric.labels(*key)
+
+
+# The only fields of a gitlab pipeline that we look at.  Pipelines are turned into these compact
+# records as they are decoded, rather than kept as the full json dicts gitlab returns.
+Pipeline = collections.namedtuple('Pipeline', ['id', 'status', 'created_at', 'updated_at'])
+
 
 class IncompletePipeline(Exception):
     """ Error raised when a gitlab pipeline is not complete. """
@@ -57,186 +132,179 @@ class IncompletePipeline(Exception):
     pass
 
 
-def get_gitlab_pipelines(project, **kwargs):
-    slug = urllib.parse.quote_plus(project)
-    url = f"{GITLAB_URL}/api/v4/projects/{slug}/pipelines"
-    for branch in BRANCHES:
-        params = dict(ref=branch, order_by='updated_at', sort='asc')
-        params.update(kwargs)
-        page = 1
-        while True:
-            params['page'] = page
-            response = session.get(url, params=params, timeout=30)
-            response.raise_for_status()
-            data = response.json()
-            if not data:
-                break
+def get_gitlab_page(url, params):
+    response = session.get(url, params=params, timeout=30)
+    response.raise_for_status()
+    return response
+
+
+def decode_pipelines(response):
+    # Trim each pipeline down to a record as soon as its page is decoded, so the full json
+    # dicts can be freed before the next page arrives.  Statuses are interned so that every
+    # record shares one string per status, and comparing them against our status literals
+    # succeeds on identity without looking at the characters.
+    return [
+        Pipeline(data['id'], sys.intern(data['status']), data['created_at'], data['updated_at'])
+        for data in orjson.loads(response.content)
+    ]
+
+
+def get_gitlab_pipelines(project, branch, executor, **kwargs):
+    """ Fetch the pipelines of a branch, along with how many gitlab says there are.
+
+    The count is None when gitlab leaves it out, which it does on very large collections.
+    """
+    url = PROJECT_URLS[project]
+    params = dict(PIPELINE_PARAMS, ref=branch)
+    params.update(kwargs)
+    params['page'] = 1
+    response = get_gitlab_page(url, params)
+    total = response.headers.get('x-total')
+    pipelines = decode_pipelines(response)
+
+    total_pages = response.headers.get('x-total-pages')
+    if total_pages is not None:
+        # The page count is known up front, so fetch all remaining pages at once.
+        responses = executor.map(
+            lambda page: get_gitlab_page(url, dict(params, page=page)),
+            range(2, int(total_pages) + 1),
+        )
+        for response in responses:
+            pipelines.extend(decode_pipelines(response))
+        return pipelines, total
+
+    # Gitlab omits the page count on very large collections.  Follow the next links instead.
+    while 'next' in response.links:
+        response = get_gitlab_page(response.links['next']['url'], None)
+        pipelines.extend(decode_pipelines(response))
+    return pipelines, total
+
+
+def retrieve_gitlab_pipelines():
+    # Only ask gitlab for what changed since the last scrape of each branch.
+    since = {}
+    for key in PROJECT_BRANCHES:
+        since[key] = START
+        if key in _last_updated_at:
+            overlap = parse_timestamp(_last_updated_at[key]) - WATERMARK_OVERLAP
+            since[key] = overlap.isoformat()
+
+    results = branch_executor.map(
+        lambda key: get_gitlab_pipelines(*key, page_executor, updated_after=since[key]),
+        PROJECT_BRANCHES,
+    )
 
-            yield from data
-            page = page + 1
+    updates = {}
+    for key, (pipelines, total) in zip(PROJECT_BRANCHES, results):
+        updates[key] = pipelines
+        if not pipelines:
+            continue
+        if total is not None and len({p.id for p in pipelines}) < int(total):
+            # A pipeline updated while we were paging shifted the rest of the list, so some
+            # rows were skipped.  Keep the watermark where it was, so the next scrape reads
+            # this whole range again.
+            logging.info("Missed pipelines of %s %s, reading them again next scrape", *key)
+            continue
+        latest = max(p.updated_at for p in pipelines)
+        _last_updated_at[key] = max(latest, _last_updated_at.get(key, latest))
 
+    return updates
 
-def gitlab_pipelines_total(data):
-    for branch in BRANCHES:
-        counts = {}
-        for project, pipelines in data.items():
-            counts[project] = counts.get(project, 0)
-            for pipeline in pipelines:
-                if pipeline['ref'] != branch:
-                    continue
-                counts[project] += 1
 
-        for project in counts:
-            yield counts[project], [project, branch]
+def prune_pipelines(cutoff):
+    """ Forget pipelines that are not running and have not been updated since cutoff. """
+    for key, store in _pipeline_store.items():
+        stale = [i for i, p in store.items() if p.updated_at < cutoff and p.status != "running"]
+        for pipeline_id in stale:
+            del store[pipeline_id]
+            _durations.pop(pipeline_id, None)
+        _seen[key] = _seen.get(key, set()) & store.keys()
 
 
-def retrieve_gitlab_pipelines(**kwargs):
-    result = {}
-    for project in PROJECTS:
-        result[project] = list(get_gitlab_pipelines(project, **kwargs))
-    return result
+def parse_timestamp(value):
+    # fromisoformat() only accepts a trailing "Z" from python 3.11 onwards
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
 
 
 def calculate_duration(pipeline):
-    if pipeline['status'] != 'success':
+    if pipeline.status != 'success':
         # Duration is undefined.
         # Failed pipelines can be restarted an arbitrary number of times.  A pipeline isn't done
         # until it succeeds, which makes it hard to handle in a prometheus Counter.
         raise IncompletePipeline(
             "Pipeline is not yet complete.  Duration is undefined."
         )
-    return (
-        arrow.get(pipeline['updated_at']) - arrow.get(pipeline['created_at'])
+    duration = (
+        parse_timestamp(pipeline.updated_at) - parse_timestamp(pipeline.created_at)
     ).total_seconds()
+    _durations[pipeline.id] = duration
+    return duration
 
 
-def find_applicable_buckets(duration):
-    buckets = DURATION_BUCKETS + ["+Inf"]
-    for bucket in buckets:
-        if duration < float(bucket):
-            yield bucket
-
-
-def gitlab_pipeline_duration_seconds(data):
-    duration_buckets = DURATION_BUCKETS + ["+Inf"]
-
-    for branch in BRANCHES:
-        # Build counts of observations into histogram "buckets"
-        counts = {}
-        # Sum of all observed durations
-        durations = {}
-        for project, pipelines in data.items():
-            for pipeline in pipelines:
-                if pipeline['ref'] != branch:
-                    continue
-
-                try:
-                    duration = calculate_duration(pipeline)
-                except IncompletePipeline:
-                    continue
-
-                # Initialize structures
-                durations[project] = durations.get(project, 0)
-                counts[project] = counts.get(project, {})
-                for bucket in duration_buckets:
-                    counts[project][bucket] = counts[project].get(bucket, 0)
-
-                # Increment applicable bucket counts and duration sums
-                durations[project] += duration
-                for bucket in find_applicable_buckets(duration):
-                    counts[project][bucket] += 1
-
-        for project in counts:
-            buckets = [
-                (str(bucket), counts[project][bucket])
-                for bucket in duration_buckets
-            ]
-            yield buckets, durations[project], [project, branch]
-
-
-# A cache that prevents us from letting the error counter decrement if a pipeline failes, is
-# retried, and then succeeds.  If we ever observe a pipeline to fail -- always count it as an
-# error after that.
+# The ids of the pipelines that have been counted as errors.  If we ever observe a pipeline to
+# fail -- it is counted as an error once, no matter how often it is retried after that.
 _seen = {}
 
 
-def _errored(project, pipelines):
-    _seen[project] = _seen.get(project, [])
-    errors = [p for p in pipelines if p['status'] == "failed" or p['id'] in _seen[project]]
-    _seen[project] = [p['id'] for p in errors]
-    return errors
-
-
-def errored(data):
-    result = {}
-    for project, pipelines in data.items():
-        result[project] = _errored(project, pipelines)
-    return result
+def record_pipelines(key, pipelines):
+    """ Merge updated pipelines into the store and update the metrics for what changed. """
+    store = _pipeline_store.setdefault(key, {})
+    seen = _seen.setdefault(key, set())
+    for pipeline in pipelines:
+        previous = store.get(pipeline.id)
+        # Overwrite by id, so retried pipelines replace their earlier state.
+        store[pipeline.id] = pipeline
+
+        if previous is None:
+            gitlab_pipelines_total.labels(*key).inc()
+        if pipeline.status == "failed" and pipeline.id not in seen:
+            seen.add(pipeline.id)
+            gitlab_pipeline_errors_total.labels(*key).inc()
+        if previous is not None and previous.status == "running":
+            gitlab_in_progress_pipelines.labels(*key).dec()
+        if pipeline.status == "running":
+            gitlab_in_progress_pipelines.labels(*key).inc()
+
+        if pipeline.id in _durations:
+            # Its duration was observed when we first saw it succeed
+            continue
+        try:
+            duration = calculate_duration(pipeline)
+        except IncompletePipeline:
+            continue
+        gitlab_pipeline_duration_seconds.labels(*key).observe(duration)
 
 
 def scrape():
-    global START
-    START = datetime.datetime.utcnow().date().isoformat()
-
-    pipelines = retrieve_gitlab_pipelines(updated_after=START)
-
-    gitlab_pipelines_total_family = CounterMetricFamily(
-        'gitlab_pipelines_total', 'Count of all gitlab pipelines', labels=LABELS
-    )
-    for value, labels in gitlab_pipelines_total(pipelines):
-        gitlab_pipelines_total_family.add_metric(labels, value)
-
-    gitlab_pipeline_errors_total_family = CounterMetricFamily(
-        'gitlab_pipeline_errors_total', 'Count of all gitlab pipeline errors', labels=LABELS
-    )
-    error_pipelines = errored(pipelines)
-    for value, labels in gitlab_pipelines_total(error_pipelines):
-        gitlab_pipeline_errors_total_family.add_metric(labels, value)
-
-    gitlab_in_progress_pipelines_family = GaugeMetricFamily(
-        'gitlab_in_progress_pipelines',
-        'Count of all in-progress gitlab pipelines',
-        labels=LABELS,
-    )
-    in_progress_pipelines = retrieve_gitlab_pipelines(status="running")
-    for value, labels in gitlab_pipelines_total(in_progress_pipelines):
-        gitlab_in_progress_pipelines_family.add_metric(labels, value)
-
-    gitlab_pipeline_duration_seconds_family = HistogramMetricFamily(
-        'gitlab_pipeline_duration_seconds',
-        'Histogram of gitlab pipeline durations',
-        labels=LABELS,
-    )
-    for buckets, duration_sum, labels in gitlab_pipeline_duration_seconds(pipelines):
-        gitlab_pipeline_duration_seconds_family.add_metric(
-            labels, buckets, sum_value=duration_sum
-        )
-
-    # Replace this in one atomic operation to avoid race condition to the Expositor
-    metrics.update(
-        {
-            'gitlab_pipelines_total': gitlab_pipelines_total_family,
-            'gitlab_pipeline_errors_total': gitlab_pipeline_errors_total_family,
-            'gitlab_in_progress_pipelines': gitlab_in_progress_pipelines_family,
-            'gitlab_pipeline_duration_seconds': gitlab_pipeline_duration_seconds_family,
-        }
-    )
-
-
-class Expositor(object):
-    """ Responsible for exposing metrics to prometheus """
-
-    def collect(self):
-        logging.info("Serving prometheus data")
-        for key in sorted(metrics):
-            yield metrics[key]
+    global START, _pruned_on
+    today = datetime.datetime.utcnow().date()
+    if START is None:
+        START = today.isoformat()
+    if today != _pruned_on:
+        _pruned_on = today
+        prune_pipelines((today - RETENTION).isoformat())
+
+    # The watermark overlap, and gitlab matching updated_after inclusively, hand back pipelines
+    # we already have.  Only those that changed since we stored them need recording.
+    updates = {}
+    for key, pipelines in retrieve_gitlab_pipelines().items():
+        store = _pipeline_store.get(key, {})
+        changed = [p for p in pipelines if store.get(p.id) != p]
+        if changed:
+            updates[key] = changed
+
+    if not updates:
+        logging.debug("No pipelines updated since the last scrape")
+        return
+
+    for key, pipelines in updates.items():
+        record_pipelines(key, pipelines)
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
-    for collector in list(REGISTRY._collector_to_names):
+    for collector in (GC_COLLECTOR, PLATFORM_COLLECTOR, PROCESS_COLLECTOR):
         REGISTRY.unregister(collector)
-    REGISTRY.register(Expositor())
 
     # Popluate data before exposing over http
     scrape()